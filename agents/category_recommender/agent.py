@@ -7,6 +7,7 @@ import logging
 
 
 from recommend_course_from_category import CategoryCourseRecommender
+from neo4j_client import close_driver
 
 # --- Agent-specific Data Structures ---
 
@@ -88,6 +89,7 @@ def main():
     finally:
         if agent_instance:
             agent_instance.close()
+        close_driver()
 
 if __name__ == "__main__":
     main()
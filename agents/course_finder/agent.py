@@ -2,12 +2,10 @@
 import argparse
 import dataclasses
 import logging
-import os
 
 
-from neo4j import GraphDatabase
-
 from get_course_candidates_for_query import CourseFinder
+from neo4j_client import get_driver, close_driver
 
 # --- Agent-specific Data Structures ---
 
@@ -37,36 +35,40 @@ class FindCoursesResponse:
     """The response from the CourseFinderAgent."""
     courses: list[CourseCandidate]
 
-# --- Neo4j Configuration ---
-NEO4J_URI = os.getenv("NEO4J_URI", "bolt://localhost:7687")
-NEO4J_USER = os.getenv("NEO4J_USER", "neo4j")
-NEO4J_PASSWORD = os.getenv("NEO4J_PASSWORD", "12345678")
-
 class CourseFinderAgent:
     """
     An agent specialized in finding existing yoga courses based on a user query.
     """
     def __init__(self, api_type: str):
         self.finder = CourseFinder(api_type=api_type)
-        self.neo4j_driver = GraphDatabase.driver(NEO4J_URI, auth=(NEO4J_USER, NEO4J_PASSWORD))
+        self.neo4j_driver = get_driver()
 
     def _get_course_details(self, tx, course_names: list[str]) -> list[CourseCandidate]:
         """Retrieves full course details, including the pose sequence, from Neo4j."""
         # This query fetches the course and collects all its poses and their sequence details.
+        # The subquery sorts each course's own poses before collecting them, in plain Cypher,
+        # instead of sorting every (course, pose) row together. Courses without poses are left out.
         query = """
         UNWIND $course_names AS course_name
-        MATCH (c:Course {id: course_name})-[rel:INCLUDES_POSE]->(p:Pose)
-        WITH c, rel, p
-        ORDER BY rel.order
+        MATCH (c:Course {id: course_name})
+        CALL {
+            WITH c
+            MATCH (c)-[rel:INCLUDES_POSE]->(p:Pose)
+            WITH p, rel
+            ORDER BY rel.order
+            RETURN collect({
+                pose_name: p.id, 
+                order: rel.order, 
+                duration_seconds: rel.duration_seconds
+            }) AS sequence
+        }
+        WITH c, sequence
+        WHERE sequence <> []
         RETURN c.id AS name, 
                c.description AS description, 
                c.challenge AS challenge, 
                c.total_duration AS total_duration, 
-               collect({
-                   pose_name: p.id, 
-                   order: rel.order, 
-                   duration_seconds: rel.duration_seconds
-               }) AS sequence
+               sequence
         """
         results = tx.run(query, course_names=course_names)
         
@@ -112,7 +114,6 @@ class CourseFinderAgent:
     def close(self):
         """Clean up resources."""
         self.finder.close()
-        self.neo4j_driver.close()
 
 def main():
     parser = argparse.ArgumentParser(description="Course Finder Agent")
@@ -154,6 +155,7 @@ def main():
     finally:
         if agent_instance:
             agent_instance.close()
+        close_driver()
 
 if __name__ == "__main__":
     main()
@@ -1,13 +1,12 @@
-import os, json
-from neo4j import GraphDatabase
+import json
+from concurrent.futures import ThreadPoolExecutor
 import chromadb
 from chromadb.config import Settings
-from chromadb.utils import embedding_functions
+
+from chroma_client import get_embedding_function
+from neo4j_client import get_driver, close_driver
 
 # Configuration
-NEO4J_URI = os.getenv("NEO4J_URI", "bolt://localhost:7687")
-NEO4J_USER = os.getenv("NEO4J_USER", "neo4j")
-NEO4J_PASSWORD = os.getenv("NEO4J_PASSWORD", "12345678")
 INPUT_DATA_DIR = "/home/xli/NAS/home/bin/yoga-info-processing"
 CHROMA_PERSIST_DIR = f"{INPUT_DATA_DIR}/chroma_db"
 POSE_JSON = f"{INPUT_DATA_DIR}/array_pose.json"
@@ -18,6 +17,29 @@ COURSE_JSON = f"{INPUT_DATA_DIR}/array_course.json"
 CHROMA_COLLECTION_POSE = "yoga_pose"
 CHROMA_COLLECTION_COURSE = "yoga_course"
 CHROMA_COLLECTION_CATEGORY = "yoga_category"
+# Documents per collection.add call; each call embeds its documents in one model batch
+CHROMA_BATCH_SIZE = 256
+# The embedding function returns unit-length vectors, so inner product ranks exactly like cosine
+# without dividing by the vector norms on every comparison
+CHROMA_DISTANCE_SPACE = "ip"
+
+# Relationship types can't be query parameters, so each type gets its own fixed statement,
+# built once so every run sends identical text and reuses Neo4j's cached plan.
+# Keyed by the pose field that lists the relationship targets.
+POSE_RELATIONSHIP_QUERIES = {
+    field: f"""
+    UNWIND $rows AS row
+    MATCH (source:Pose {{id: row.source_name}})
+    MATCH (target:Pose {{id: row.target_name}})
+    MERGE (source)-[:{rel_type}]->(target)
+    """
+    for rel_type, field in [
+        ("BUILD_UP", "build_up"),
+        ("MOVE_FORWARD", "move_forward"),
+        ("BALANCE_OUT", "balance_out"),
+        ("UNWIND", "unwind")
+    ]
+}
 
 def delete_chroma_collection(chroma_client, collection_name: str):
     existing = [col.name for col in chroma_client.list_collections()]
@@ -37,6 +59,16 @@ def load_json_data(file_path):
     with open(file_path) as f:
         return json.load(f)
 
+def load_source_data():
+    """Load every source JSON file once, keyed by its top-level key"""
+    return {
+        "pose": load_json_data(POSE_JSON)["pose"],
+        "attribute": load_json_data(ATTRIBUTE_JSON)["attribute"],
+        "category": load_json_data(CATEGORY_JSON)["category"],
+        "challenge": load_json_data(CHALLENGE_JSON)["challenge"],
+        "course": load_json_data(COURSE_JSON)["course"]
+    }
+
 def create_neo4j_nodes(tx, node_type, items, id_field):
     """Create nodes in Neo4j"""
     query = f"""
@@ -48,106 +80,115 @@ def create_neo4j_nodes(tx, node_type, items, id_field):
 
 def link_pose_to_references(tx):
     """Create relationships between poses and reference nodes"""
+    # One statement for all three reference types: planned once, sent in one round trip
     link_query = """
-    MATCH (p:Pose), (ref:{reference_type} {{id: p.{reference_field}}})
-    MERGE (p)-[:{relationship}]->(ref)
-    """
-    references = [
-        ("Attribute", "attribute", "HAS_ATTRIBUTE"),
-        ("Category", "category", "IN_CATEGORY"),
-        ("Challenge", "challenge", "HAS_CHALLENGE")
-    ]
-    
-    for ref_type, field, rel in references:
-        tx.run(link_query.format(
-            reference_type=ref_type,
-            reference_field=field,
-            relationship=rel
-        ))
-
-def create_pose_relationships(tx, pose):
-    """Create relationships between poses"""
-    relationships = {
-        "BUILD_UP": pose.get("build_up", []),
-        "MOVE_FORWARD": pose.get("move_forward", []),
-        "BALANCE_OUT": pose.get("balance_out", []),
-        "UNWIND": pose.get("unwind", [])
+    CALL {
+        MATCH (p:Pose), (ref:Attribute {id: p.attribute})
+        MERGE (p)-[:HAS_ATTRIBUTE]->(ref)
+        RETURN count(*) AS attributes
     }
-    
-    for rel_type, targets in relationships.items():
-        for target in targets:
-            tx.run("""
-            MATCH (source:Pose {id: $source_name})
-            MATCH (target:Pose {id: $target_name})
-            MERGE (source)-[:%s]->(target)
-            """ % rel_type,
-            source_name=pose["name"],
-            target_name=target)
-
-# Update the create_course_nodes function
+    CALL {
+        MATCH (p:Pose), (ref:Category {id: p.category})
+        MERGE (p)-[:IN_CATEGORY]->(ref)
+        RETURN count(*) AS categories
+    }
+    CALL {
+        MATCH (p:Pose), (ref:Challenge {id: p.challenge})
+        MERGE (p)-[:HAS_CHALLENGE]->(ref)
+        RETURN count(*) AS challenges
+    }
+    RETURN attributes, categories, challenges
+    """
+    tx.run(link_query)
+
+def create_pose_relationships(tx, poses):
+    """Create relationships between poses, with one batched query per relationship type"""
+    for field, query in POSE_RELATIONSHIP_QUERIES.items():
+        rows = [
+            {"source_name": pose["name"], "target_name": target}
+            for pose in poses
+            for target in pose.get(field, [])
+        ]
+        tx.run(query, rows=rows)
+
 def create_course_nodes(tx, courses):
     """Create course nodes and relationships with support for repeated poses"""
-    for course in courses:
-        # Create course node
-        tx.run("""
-        MERGE (c:Course {id: $name})
-        SET c += {
-            challenge: $challenge,
-            description: $description,
-            total_duration: $total_duration
+    course_rows = [
+        {
+            "name": course["name"],
+            "challenge": course["challenge"],
+            "description": course["description"],
+            "total_duration": course["total_duration"]
         }
-        """, 
-        name=course["name"],
-        challenge=course["challenge"],
-        description=course["description"],
-        total_duration=course["total_duration"])
-        
-        # Create sequence relationships with unique identifiers
-        for i, step in enumerate(course["sequence"]):
-            # Generate unique relationship ID
-            rel_id = f"{course['name']}_{step['pose']}_{i}"
-            
-            tx.run("""
-            MATCH (c:Course {id: $course_name})
-            MATCH (p:Pose {id: $pose_name})
-            MERGE (c)-[rel:INCLUDES_POSE {
-                id: $rel_id,
-                order: $order
-            }]->(p)
-            SET rel += {
-                duration_seconds: $duration_seconds,
-                repeat_times: $repeat_times,
-                transition_note: $transition_notes,
-                action_note: $action_note
-            }
-            """,
-            course_name=course["name"],
-            pose_name=step["pose"],
-            rel_id=rel_id,
-            order=i+1,
-            duration_seconds=step["duration_seconds"],
-            repeat_times=step["repeat_times"],
-            transition_notes=step["transition_notes"],
-            action_note=step["action_note"])
-        
-        # Link course to challenge
-        tx.run("""
-        MATCH (c:Course {id: $name})
-        MATCH (ch:Challenge {level: $challenge})
-        MERGE (c)-[:HAS_CHALLENGE]->(ch)
-        """,
-        name=course["name"],
-        challenge=course["challenge"])
-
-def build_knowledge_graph(driver):
+        for course in courses
+    ]
+
+    # Create course nodes
+    tx.run("""
+    UNWIND $courses AS course
+    MERGE (c:Course {id: course.name})
+    SET c += {
+        challenge: course.challenge,
+        description: course.description,
+        total_duration: course.total_duration
+    }
+    """,
+    courses=course_rows)
+
+    # Create sequence relationships with unique identifiers
+    step_rows = [
+        {
+            "course_name": course["name"],
+            "pose_name": step["pose"],
+            "rel_id": f"{course['name']}_{step['pose']}_{i}",
+            "order": i+1,
+            "duration_seconds": step["duration_seconds"],
+            "repeat_times": step["repeat_times"],
+            "transition_notes": step["transition_notes"],
+            "action_note": step["action_note"]
+        }
+        for course in courses
+        for i, step in enumerate(course["sequence"])
+    ]
+
+    tx.run("""
+    UNWIND $steps AS step
+    MATCH (c:Course {id: step.course_name})
+    MATCH (p:Pose {id: step.pose_name})
+    MERGE (c)-[rel:INCLUDES_POSE {
+        id: step.rel_id,
+        order: step.order
+    }]->(p)
+    SET rel += {
+        duration_seconds: step.duration_seconds,
+        repeat_times: step.repeat_times,
+        transition_note: step.transition_notes,
+        action_note: step.action_note
+    }
+    """,
+    steps=step_rows)
+
+    # Link courses to challenges
+    tx.run("""
+    UNWIND $courses AS course
+    MATCH (c:Course {id: course.name})
+    MATCH (ch:Challenge {level: course.challenge})
+    MERGE (c)-[:HAS_CHALLENGE]->(ch)
+    """,
+    courses=course_rows)
+
+def build_knowledge_graph(driver, data):
     """Main function to build the knowledge graph"""   
-    # Load data
-    pose_data = load_json_data(POSE_JSON)["pose"]
-    attributes = load_json_data(ATTRIBUTE_JSON)["attribute"]
-    categories = load_json_data(CATEGORY_JSON)["category"]
-    challenges = load_json_data(CHALLENGE_JSON)["challenge"]
-    courses = load_json_data(COURSE_JSON)["course"]
-    
+    # Prepare the values in Python so the MERGEs write them correctly the first time.
+    # Copies, since the Chroma builders read the same data concurrently.
+    # Pose.challenge is stored as an integer to match Challenge.id
+    pose_data = [{**pose, "challenge": int(pose["challenge"])} for pose in data["pose"]]
+    # Attribute ids get a capital first letter to match Pose.attribute (like apoc.text.capitalize)
+    attributes = [{**attribute, "name": attribute["name"][:1].upper() + attribute["name"][1:]} for attribute in data["attribute"]]
+    categories = data["category"]
+    challenges = data["challenge"]
+    courses = data["course"]
+
     with driver.session() as session:
         # Create reference nodes
         session.execute_write(create_neo4j_nodes, "Attribute", attributes, "name")
@@ -157,39 +198,31 @@ def build_knowledge_graph(driver):
         # Create pose nodes
         session.execute_write(create_neo4j_nodes, "Pose", pose_data, "name")
 
-        # update the challenge property to long type to match Challenge.id
-        session.execute_write(
-            lambda tx: tx.run("""
-                MATCH (p:Pose)
-                SET p.challenge = toInteger(p.challenge)
-                """))
-        
-        # update Attribute id to capital letter to match Pose.attribute
-        session.execute_write(
-            lambda tx: tx.run("""
-                MATCH (a:Attribute)
-                SET a.id = apoc.text.capitalize(a.id)
-            """))
-        
         # Link poses to references
         session.execute_write(link_pose_to_references)
         
         # Create inter-pose relationships
-        for pose in pose_data:
-            session.execute_write(create_pose_relationships, pose)
+        session.execute_write(create_pose_relationships, pose_data)
 
         # create courses
         session.execute_write(create_course_nodes, courses)
 
-    driver.close()
     print("Knowledge graph built successfully!")
     print(f"Created {len(pose_data)} pose nodes")
 
-def add_to_chroma(collection, pose):
+def add_to_chroma(collection, documents, metadatas, ids):
+    """Add documents to a ChromaDB collection in batches"""
+    for start in range(0, len(ids), CHROMA_BATCH_SIZE):
+        end = start + CHROMA_BATCH_SIZE
+        collection.add(
+            documents=documents[start:end],
+            metadatas=metadatas[start:end],
+            ids=ids[start:end]
+        )
 
-    """Add pose fields to ChromaDB collection"""
-    fields = {
-        "name": pose["name"],
+def get_pose_fields(pose):
+    """Get the pose fields that are indexed in ChromaDB"""
+    return {
         "introduction": pose.get("introduction", ""),
         "steps": "\n".join(pose.get("steps", [])),
         "modification": pose.get("modification", ""),
@@ -198,51 +231,52 @@ def add_to_chroma(collection, pose):
         "practice_note": pose.get("practice_note", ""),
         "how_to_come_out": pose.get("how_to_come_out", "")
     }
-    
-    for field_name, text in fields.items():
-        if text:
-            collection.add(
-                documents=[text],
-                metadatas=[{"pose": pose["name"], "field": field_name}],
-                ids=[f"{pose['name']}_{field_name}"]
-            )
-
-def build_pose_chroma_db(chroma_client):
-    sentence_transformer_ef = embedding_functions.SentenceTransformerEmbeddingFunction(
-        model_name="all-MiniLM-L6-v2"
-    )
+
+def get_pose_documents(pose):
+    """
+    Group the pose fields into field-tagged documents, one vector each.
+    The steps are long enough to fill the model's 256-token input on their own,
+    so they get a document of their own and the shorter fields share the other one.
+    """
+    fields = get_pose_fields(pose)
+    groups = {
+        "overview": [f for f in fields if f != "steps"],
+        "steps": ["steps"]
+    }
+    documents = {}
+    for group, field_names in groups.items():
+        sections = [f"[{f}]\n{fields[f]}" for f in field_names if fields[f]]
+        if sections:
+            documents[group] = f"Pose: {pose['name']}\n" + "\n".join(sections)
+    return documents
+
+def build_pose_chroma_db(chroma_client, embedding_function, pose_data):
     collection = chroma_client.get_or_create_collection(
         name=CHROMA_COLLECTION_POSE,
-        embedding_function=sentence_transformer_ef,
-        metadata={"hnsw:space": "cosine"}
+        embedding_function=embedding_function,
+        metadata={"hnsw:space": CHROMA_DISTANCE_SPACE}
     )
-    # Load data
-    pose_data = load_json_data(POSE_JSON)["pose"]
     # Add to ChromaDB
+    documents, metadatas, ids = [], [], []
     for pose in pose_data:
-        add_to_chroma(collection, pose)
+        for group, text in get_pose_documents(pose).items():
+            documents.append(text)
+            metadatas.append({"pose": pose["name"], "field": group})
+            ids.append(f"{pose['name']}_{group}")
+    add_to_chroma(collection, documents, metadatas, ids)
 
     print(f"Yoga pose ChromaDB collection contains {collection.count()} documents")
 
-def build_category_chroma_db(chroma_client):
+def build_category_chroma_db(chroma_client, embedding_function, category_data):
     """Build ChromaDB collection for yoga categories"""
-    sentence_transformer_ef = embedding_functions.SentenceTransformerEmbeddingFunction(
-        model_name="all-MiniLM-L6-v2"
-    )
     collection = chroma_client.get_or_create_collection(
         name=CHROMA_COLLECTION_CATEGORY,
-        embedding_function=sentence_transformer_ef,
-        metadata={"hnsw:space": "cosine"}
+        embedding_function=embedding_function,
+        metadata={"hnsw:space": CHROMA_DISTANCE_SPACE}
     )
     
-    # Load course data
-    try:
-        category_data = load_json_data(CATEGORY_JSON)["category"]
-    except Exception as e:
-        print(f"⚠️ Failed to load category data: {str(e)}")
-        return
-    
-    # Add courses to collection
+    # Add categories to collection
+    documents, metadatas, ids = [], [], []
     for category in category_data:
         # Create a comprehensive document for semantic search
         guidelines = "\n".join(category.get("guidelines", []))
@@ -253,36 +287,25 @@ def build_category_chroma_db(chroma_client):
             f"Guidelines:{guidelines}"
         )
         
-        collection.add(
-            documents=[document],
-            ids=[category['name']],
-            metadatas=[{
-                "category": category['name']
-            }]
-        )
-    
+        documents.append(document)
+        metadatas.append({"category": category['name']})
+        ids.append(category['name'])
+
+    add_to_chroma(collection, documents, metadatas, ids)
+
     print(f"Yoga category ChromaDB collection contains {collection.count()} documents")
 
 
-def build_course_chroma_db(chroma_client):
+def build_course_chroma_db(chroma_client, embedding_function, course_data):
     """Build ChromaDB collection for yoga courses"""
-    sentence_transformer_ef = embedding_functions.SentenceTransformerEmbeddingFunction(
-        model_name="all-MiniLM-L6-v2"
-    )
     collection = chroma_client.get_or_create_collection(
         name=CHROMA_COLLECTION_COURSE,
-        embedding_function=sentence_transformer_ef,
-        metadata={"hnsw:space": "cosine"}
+        embedding_function=embedding_function,
+        metadata={"hnsw:space": CHROMA_DISTANCE_SPACE}
     )
     
-    # Load course data
-    try:
-        course_data = load_json_data(COURSE_JSON)["course"]
-    except Exception as e:
-        print(f"⚠️ Failed to load course data: {str(e)}")
-        return
-    
     # Add courses to collection
+    documents, metadatas, ids = [], [], []
     for course in course_data:
         # Create a comprehensive document for semantic search
         sequence_str = "\n".join(
@@ -298,19 +321,30 @@ def build_course_chroma_db(chroma_client):
             #f"Sequence:\n{sequence_str}"
         )
         
-        collection.add(
-            documents=[document],
-            ids=[course['name']],
-            metadatas=[{
-                "course": course['name'],
-                "challenge": course['challenge'],
-                "duration": course['total_duration']
-                }]
-        )
-    
+        documents.append(document)
+        metadatas.append({
+            "course": course['name'],
+            "challenge": course['challenge'],
+            "duration": course['total_duration']
+        })
+        ids.append(course['name'])
+
+    add_to_chroma(collection, documents, metadatas, ids)
+
     print(f"Yoga course ChromaDB collection contains {collection.count()} documents")
 
 
+def rebuild_chroma_collection(chroma_client, collection_name, build_collection, embedding_function, items):
+    """Delete a ChromaDB collection and build it again"""
+    delete_chroma_collection(chroma_client, collection_name)
+    build_collection(chroma_client, embedding_function, items)
+
+def rebuild_knowledge_graph(driver, data):
+    """Clear the Neo4j database and build the knowledge graph again"""
+    delete_neo4j_database(driver)
+    build_knowledge_graph(driver, data)
+
+
 def check_neo4j_dbms_connection(driver):
     try:
         driver.verify_connectivity()
@@ -341,15 +375,30 @@ if __name__ == "__main__":
     # Initialize Neo4j driver and ChromaDB client
     check_chroma_dir_permission()
     chroma_client = chromadb.PersistentClient(path=CHROMA_PERSIST_DIR)
-    delete_chroma_collection(chroma_client, CHROMA_COLLECTION_POSE)
-    build_pose_chroma_db(chroma_client)
-    delete_chroma_collection(chroma_client, CHROMA_COLLECTION_COURSE) 
-    build_course_chroma_db(chroma_client)
-    delete_chroma_collection(chroma_client, CHROMA_COLLECTION_CATEGORY)     
-    build_category_chroma_db(chroma_client)
-
-    driver = GraphDatabase.driver(NEO4J_URI, auth=(NEO4J_USER, NEO4J_PASSWORD))
+    driver = get_driver()
     check_neo4j_dbms_connection(driver)
-    delete_neo4j_database(driver)
-    build_knowledge_graph(driver)
+
+    # Parse every source file once; the builders only read the shared data
+    data = load_source_data()
+
+    # Load the model once, before starting the threads, and share it across the three collections
+    embedding_function = get_embedding_function()
+    # The first call configures the tokenizer's truncation and padding, which is not safe to race
+    # across threads, so make it here before the builders encode concurrently
+    embedding_function(["warmup"])
+
+    try:
+        # The three collections and the knowledge graph are independent, so build them concurrently
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            futures = [
+                executor.submit(rebuild_chroma_collection, chroma_client, CHROMA_COLLECTION_POSE, build_pose_chroma_db, embedding_function, data["pose"]),
+                executor.submit(rebuild_chroma_collection, chroma_client, CHROMA_COLLECTION_COURSE, build_course_chroma_db, embedding_function, data["course"]),
+                executor.submit(rebuild_chroma_collection, chroma_client, CHROMA_COLLECTION_CATEGORY, build_category_chroma_db, embedding_function, data["category"]),
+                executor.submit(rebuild_knowledge_graph, driver, data)
+            ]
+            # Re-raise the first failure, if any
+            for future in futures:
+                future.result()
+    finally:
+        close_driver()
     
@@ -1,15 +1,25 @@
 
 import os
 import json
+import random
+import asyncio
 import argparse
-from openai import OpenAI
-from neo4j import GraphDatabase
+from openai import AsyncOpenAI
+
+import llm_cache
+from query_prompt import get_query_prompt_template
+from neo4j_client import get_driver, close_driver
+
+
+def _as_terms(value) -> list[str]:
+    """
+    Normalizes a list field of the extracted query info: a bare string becomes a one-item list
+    and empty items are dropped, so the terms can be sorted into a stable prompt and cache key.
+    """
+    if isinstance(value, str):
+        value = [value]
+    return [str(item) for item in value or [] if item]
 
-# Configuration - Load from environment variables
-NEO4J_URI = os.getenv("NEO4J_URI", "bolt://localhost:7687")
-NEO4J_USER = os.getenv("NEO4J_USER", "neo4j")
-NEO4J_PASSWORD = os.getenv("NEO4J_PASSWORD", "12345678")
-PROMPT_FILE_PATH = "/home/xli/NAS/home/bin/yoga-info-processing/get_user_query_key_info.prompt"
 
 class YogaPoseChecker:
     """
@@ -27,7 +37,9 @@ class YogaPoseChecker:
         self.api_client = None
         self.api_model = ""
         self._init_api_client(api_type)
-        self.neo4j_driver = GraphDatabase.driver(NEO4J_URI, auth=(NEO4J_USER, NEO4J_PASSWORD))
+        self._prompt_template = get_query_prompt_template()
+        self._llm_semaphore = asyncio.Semaphore(llm_cache.LLM_MAX_ASYNC)
+        self.neo4j_driver = get_driver()
 
     def _init_api_client(self, api_type: str):
         """Initializes the LLM API client."""
@@ -35,40 +47,67 @@ class YogaPoseChecker:
             api_key = os.getenv('DEEPSEEK_API_KEY')
             if not api_key:
                 raise RuntimeError("Missing DEEPSEEK_API_KEY")
-            self.api_client = OpenAI(api_key=api_key, base_url="https://api.deepseek.com/v1")
+            self.api_client = AsyncOpenAI(
+                api_key=api_key,
+                base_url="https://api.deepseek.com/v1",
+                max_retries=llm_cache.LLM_MAX_RETRIES
+            )
             self.api_model = "deepseek-chat"
         elif api_type == 'openai':
             api_key = os.getenv('OPENAI_API_KEY')
             if not api_key:
                 raise RuntimeError("Missing OPENAI_API_KEY")
-            self.api_client = OpenAI(api_key=api_key)
+            self.api_client = AsyncOpenAI(api_key=api_key, max_retries=llm_cache.LLM_MAX_RETRIES)
             self.api_model = "gpt-3.5-turbo"
         else:
             raise ValueError("Unsupported API type")
 
-    def _extract_query_info(self, user_query: str) -> dict:
+    async def _extract_query_info(self, user_query: str) -> dict:
         """Extracts structured info from user query using the LLM."""
-        try:
-            with open(PROMPT_FILE_PATH, 'r') as f:
-                prompt_template = f.read().format(query=user_query)
-        except FileNotFoundError:
-            raise RuntimeError(f"Prompt file not found at {PROMPT_FILE_PATH}")
-
-        response = self.api_client.chat.completions.create(
-            model=self.api_model,
-            messages=[{"role": "user", "content": prompt_template}],
+        prompt_template = self._prompt_template.format(query=user_query)
+
+        return await llm_cache.acomplete(
+            self.api_client,
+            self.api_model,
+            prompt_template,
+            parse=json.loads,
+            semaphore=self._llm_semaphore,
             temperature=0.0,
             response_format={"type": "json_object"}
         )
-        return json.loads(response.choices[0].message.content)
 
-    def _get_pose_caution(self, tx, pose_name: str) -> str:
-        """Retrieves the caution string for a given pose from Neo4j."""
-        result = tx.run("MATCH (p:Pose {id: $pose_name}) RETURN p.caution AS caution", pose_name=pose_name)
-        record = result.single()
-        return record["caution"] if record and record["caution"] else ""
+    def _read(self, transaction_function, *args):
+        """
+        Runs a read transaction in a worker thread so the blocking Neo4j driver
+        does not stall the event loop.
+        """
+        def run():
+            with self.neo4j_driver.session() as session:
+                return session.execute_read(transaction_function, *args)
+
+        return asyncio.to_thread(run)
 
-    def _is_pose_unsuitable(self, pose_name: str, caution: str, poses_to_avoid: list, contraindications: list) -> bool:
+    def _get_caution_and_replacements(self, tx, pose_name: str) -> tuple[str, list[dict]]:
+        """
+        Retrieves the caution of a pose and the other poses in its categories, in random order,
+        with their cautions, in a single query.
+        """
+        query = """
+        MATCH (original:Pose {id: $pose_name})
+        OPTIONAL MATCH (original)-[:IN_CATEGORY]->(:Category)<-[:IN_CATEGORY]-(replacement:Pose)
+        WHERE replacement <> original
+        RETURN original.caution AS caution,
+               [r IN collect(DISTINCT replacement) | {name: r.id, caution: coalesce(r.caution, "")}] AS candidates
+        """
+        record = tx.run(query, pose_name=pose_name).single()
+        if not record:
+            return "", []
+        # Shuffle here rather than with ORDER BY rand(), which makes Neo4j sort every row first
+        candidates = record["candidates"]
+        random.shuffle(candidates)
+        return record["caution"] or "", candidates
+
+    async def _is_pose_unsuitable(self, pose_name: str, caution: str, poses_to_avoid: list, contraindications: list) -> bool:
         """
         Checks with the LLM if a pose is unsuitable.
 
@@ -78,78 +117,124 @@ class YogaPoseChecker:
         if not poses_to_avoid and not contraindications:
             return False
 
+        # Sort the restrictions so the same constraints always produce the same prompt and cache key
         prompt = (
             f"Here is a yoga pose '{pose_name}' and its practice caution: '{caution}'.\n"
-            f"Check if the pose is similar to any pose in the list of poses to avoid: {poses_to_avoid}.\n"
-            f"Also, check if practicing this pose has any contraindications listed here: {contraindications}.\n"
+            f"Check if the pose is similar to any pose in the list of poses to avoid: {sorted(poses_to_avoid)}.\n"
+            f"Also, check if practicing this pose has any contraindications listed here: {sorted(contraindications)}.\n"
             f"Please answer only 'true' if it is unsuitable or 'false' if it is suitable, nothing else."
         )
 
-        response = self.api_client.chat.completions.create(
-            model=self.api_model,
-            messages=[{"role": "user", "content": prompt}],
+        # 'true' and 'false' are single tokens for both models, so one output token is enough
+        completion = await llm_cache.acomplete(
+            self.api_client,
+            self.api_model,
+            prompt,
+            semaphore=self._llm_semaphore,
             temperature=0.0,
-            max_tokens=5
+            max_tokens=1
         )
-        answer = response.choices[0].message.content.strip().lower()
+        answer = completion.strip().lower()
         return answer == 'true'
 
-    def _find_replacement_pose(self, tx, original_pose_name: str, poses_to_avoid: list, contraindications: list) -> str | None:
+    async def _check_poses_in_batch(self, candidates: list[dict], poses_to_avoid: list, contraindications: list) -> dict:
+        """
+        Checks with the LLM which candidate poses are unsuitable, in a single request.
+
+        Returns:
+            dict: A map of pose name to True if the pose is unsuitable, False otherwise.
+
+        Raises:
+            ValueError: If the response is not the expected JSON shape.
         """
-        Finds a suitable replacement pose from the same category in Neo4j.
+        # List the poses in a stable order so the same candidates always produce the same prompt and cache key
+        pose_list = "\n".join(
+            f"{i}. Pose: {candidate['name']}\n   Caution: {candidate['caution']}"
+            for i, candidate in enumerate(sorted(candidates, key=lambda c: c["name"]), 1)
+        )
+        prompt = (
+            f"Here are some yoga poses and their practice cautions:\n{pose_list}\n\n"
+            f"For each pose, check if it is similar to any pose in the list of poses to avoid: {sorted(poses_to_avoid)}.\n"
+            f"Also, check if practicing it has any contraindications listed here: {sorted(contraindications)}.\n"
+            "Use the following json format to response, nothing else:\n"
+            '{"results": [{"name": "<pose name>", "unsuitable": true | false}]}'
+        )
+
+        def parse_verdicts(completion: str) -> dict:
+            results = json.loads(completion)["results"]
+            verdicts = {item["name"]: str(item["unsuitable"]).strip().lower() == "true" for item in results}
+            if set(verdicts) != {candidate["name"] for candidate in candidates}:
+                raise ValueError(f"Batched pose check returned unexpected poses: {list(verdicts)}")
+            return verdicts
+
+        return await llm_cache.acomplete(
+            self.api_client,
+            self.api_model,
+            prompt,
+            parse=parse_verdicts,
+            semaphore=self._llm_semaphore,
+            temperature=0.0,
+            response_format={"type": "json_object"}
+        )
+
+    async def _find_replacement_pose(self, original_pose_name: str, candidates: list[dict], poses_to_avoid: list, contraindications: list) -> str | None:
         """
-        # Find other poses in the same category, excluding the original pose
-        query = """
-        MATCH (original:Pose {id: $original_pose_name})-[:IN_CATEGORY]->(cat:Category)<-[:IN_CATEGORY]-(replacement:Pose)
-        WHERE original <> replacement
-        RETURN replacement.id AS name, replacement.caution AS caution
-        ORDER BY rand()
+        Finds a suitable replacement pose among the candidates from the same category in Neo4j.
         """
-        results = tx.run(query, original_pose_name=original_pose_name)
-        
-        for record in results:
-            replacement_name = record["name"]
-            replacement_caution = record["caution"] if record["caution"] else ""
-            
-            # Check if the replacement is suitable
-            if not self._is_pose_unsuitable(replacement_name, replacement_caution, poses_to_avoid, contraindications):
-                print(f"Found suitable replacement: {replacement_name}")
-                return replacement_name
-        
+        if not candidates:
+            print(f"Could not find a suitable replacement for {original_pose_name}")
+            return None
+
+        try:
+            verdicts = await self._check_poses_in_batch(candidates, poses_to_avoid, contraindications)
+        except (KeyError, TypeError, ValueError) as e:
+            # json.JSONDecodeError is a ValueError; fall back to checking the candidates concurrently one by one.
+            print(f"Batched pose check failed ({e}), checking candidates one by one.")
+            results = await asyncio.gather(*[
+                self._is_pose_unsuitable(candidate["name"], candidate["caution"], poses_to_avoid, contraindications)
+                for candidate in candidates
+            ])
+            verdicts = {candidate["name"]: is_unsuitable for candidate, is_unsuitable in zip(candidates, results)}
+
+        # Take the first suitable candidate in the random order
+        for candidate in candidates:
+            if not verdicts[candidate["name"]]:
+                print(f"Found suitable replacement: {candidate['name']}")
+                return candidate["name"]
+
         print(f"Could not find a suitable replacement for {original_pose_name}")
         return None
 
-    def check_and_replace_pose(self, pose_name: str, user_query: str) -> str | None:
+    async def check_and_replace_pose(self, pose_name: str, user_query: str) -> str | None:
         """
         Checks if a pose is suitable based on the user query. If not, finds and returns a replacement.
         If the pose is suitable, it returns the original pose name.
         If unsuitable and no replacement is found, returns None.
         """
-        query_info = self._extract_query_info(user_query)
-        poses_to_avoid = query_info.get("poses to avoid", [])
-        contraindications = query_info.get("contraindications", [])
+        # The graph lookup does not depend on the query, so fetch it while the LLM extracts the query info
+        query_info, (caution, candidates) = await asyncio.gather(
+            self._extract_query_info(user_query),
+            self._read(self._get_caution_and_replacements, pose_name)
+        )
+        poses_to_avoid = _as_terms(query_info.get("poses to avoid"))
+        contraindications = _as_terms(query_info.get("contraindications"))
 
         # If there are no restrictions, the pose is suitable
         if not poses_to_avoid and not contraindications:
             return pose_name
 
-        with self.neo4j_driver.session() as session:
-            caution = session.execute_read(self._get_pose_caution, pose_name)
-            
-            is_unsuitable = self._is_pose_unsuitable(pose_name, caution, poses_to_avoid, contraindications)
+        is_unsuitable = await self._is_pose_unsuitable(pose_name, caution, poses_to_avoid, contraindications)
 
-            if is_unsuitable:
-                print(f"Pose '{pose_name}' is unsuitable. Finding a replacement...")
-                replacement = session.execute_read(self._find_replacement_pose, pose_name, poses_to_avoid, contraindications)
-                return replacement
-            else:
-                print(f"Pose '{pose_name}' is suitable.")
-                return pose_name
+        if is_unsuitable:
+            print(f"Pose '{pose_name}' is unsuitable. Finding a replacement...")
+            return await self._find_replacement_pose(pose_name, candidates, poses_to_avoid, contraindications)
+        else:
+            print(f"Pose '{pose_name}' is suitable.")
+            return pose_name
 
     def close(self):
-        """Closes the Neo4j driver connection."""
-        if self.neo4j_driver:
-            self.neo4j_driver.close()
+        """Releases the checker's resources. The shared Neo4j driver is closed by the process owner."""
+        self.neo4j_driver = None
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
@@ -179,7 +264,7 @@ if __name__ == "__main__":
     checker = None
     try:
         checker = YogaPoseChecker(api_type=args.api)
-        final_pose = checker.check_and_replace_pose(pose_name=args.pose, user_query=args.query)
+        final_pose = asyncio.run(checker.check_and_replace_pose(pose_name=args.pose, user_query=args.query))
         print(f"\n--- Pose Check Result ---")
         print(f"Original Pose: {args.pose}")
         print(f"User Query: '{args.query}'")
@@ -189,3 +274,4 @@ if __name__ == "__main__":
     finally:
         if checker:
             checker.close()
+        close_driver()
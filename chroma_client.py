@@ -0,0 +1,190 @@
+import os
+import hashlib
+import sqlite3
+import functools
+import threading
+from collections import OrderedDict
+import numpy as np
+import chromadb
+from chromadb.api.types import Documents, EmbeddingFunction, Embeddings
+from chromadb.utils import embedding_functions
+
+# Configuration - Load from environment variables
+CHROMA_PERSIST_DIR = os.getenv("CHROMA_PERSIST_DIR", "/home/xli/NAS/home/bin/yoga-info-processing/chroma_db")
+EMBEDDING_MODEL_NAME = "all-MiniLM-L6-v2"
+# 'sentence_transformers' runs the model with PyTorch, 'onnx' runs the same model with ONNX Runtime,
+# 'onnx_int8' runs an int8-quantized ONNX export of it on CPU (needs sentence-transformers[onnx]).
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "sentence_transformers")
+# Quantized export shipped in the model repository; use onnx/model_quint8_avx2.onnx on CPUs without AVX-512 VNNI
+EMBEDDING_ONNX_INT8_FILE = os.getenv("EMBEDDING_ONNX_INT8_FILE", "onnx/model_qint8_avx512_vnni.onnx")
+# Torch device for the sentence_transformers backend, e.g. 'cpu' or 'cuda'
+EMBEDDING_DEVICE = os.getenv("EMBEDDING_DEVICE", "cpu")
+# Query texts whose embeddings are kept in memory
+QUERY_EMBEDDING_CACHE_SIZE = 10000
+# SQLite file keeping query embeddings across runs; set to an empty string to keep them in memory only
+QUERY_EMBEDDING_CACHE_PATH = os.getenv(
+    "QUERY_EMBEDDING_CACHE_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "query_embedding_cache.sqlite3")
+)
+
+
+@functools.lru_cache(maxsize=1)
+def get_embedding_function():
+    """
+    Returns the process-wide embedding function, loading the model on first use.
+
+    All collections are embedded with all-MiniLM-L6-v2, so one instance is shared
+    instead of loading the weights again for every collection or class instance.
+    """
+    if EMBEDDING_BACKEND == "sentence_transformers":
+        # Half precision halves the weights and memory traffic on GPU; CPUs have no fast fp16 path.
+        model_kwargs = {"torch_dtype": "float16"} if EMBEDDING_DEVICE.startswith("cuda") else {}
+        return embedding_functions.SentenceTransformerEmbeddingFunction(
+            model_name=EMBEDDING_MODEL_NAME,
+            device=EMBEDDING_DEVICE,
+            normalize_embeddings=True,
+            model_kwargs=model_kwargs
+        )
+    elif EMBEDDING_BACKEND == "onnx":
+        # Chroma's bundled ONNX export of all-MiniLM-L6-v2; no PyTorch needed at query time.
+        return embedding_functions.ONNXMiniLM_L6_V2()
+    elif EMBEDDING_BACKEND == "onnx_int8":
+        # Same mean pooling and normalization as the PyTorch model, with int8 weights for faster CPU inference.
+        return embedding_functions.SentenceTransformerEmbeddingFunction(
+            model_name=EMBEDDING_MODEL_NAME,
+            device="cpu",
+            normalize_embeddings=True,
+            backend="onnx",
+            model_kwargs={"file_name": EMBEDDING_ONNX_INT8_FILE}
+        )
+    else:
+        raise ValueError(f"Unsupported EMBEDDING_BACKEND: {EMBEDDING_BACKEND}")
+
+
+class CachedEmbeddingFunction(EmbeddingFunction[Documents]):
+    """
+    Wraps an embedding function with an in-memory LRU cache keyed by text,
+    optionally backed by a SQLite file so warm entries survive restarts.
+
+    User queries repeat the same short keywords ("core", "lower back", "stress"),
+    so only texts not seen before are sent through the model.
+    """
+
+    def __init__(self, embedding_function, max_size: int = QUERY_EMBEDDING_CACHE_SIZE, cache_path: str = ""):
+        self._embedding_function = embedding_function
+        self._max_size = max_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._cache_path = cache_path
+        self._db = None
+
+    # Chroma checks an embedding function against the config persisted with a collection when
+    # it is opened, so the wrapper reports the wrapped function's name and config as its own.
+    def name(self) -> str:
+        return self._embedding_function.name()
+
+    def get_config(self) -> dict:
+        return self._embedding_function.get_config()
+
+    @staticmethod
+    def build_from_config(config: dict) -> "CachedEmbeddingFunction":
+        return CachedEmbeddingFunction(type(get_embedding_function()).build_from_config(config))
+
+    def is_legacy(self) -> bool:
+        return self._embedding_function.is_legacy()
+
+    def default_space(self):
+        return self._embedding_function.default_space()
+
+    def supported_spaces(self) -> list:
+        return self._embedding_function.supported_spaces()
+
+    def validate_config(self, config: dict):
+        self._embedding_function.validate_config(config)
+
+    def validate_config_update(self, old_config: dict, new_config: dict):
+        self._embedding_function.validate_config_update(old_config, new_config)
+
+    def _get_db(self) -> sqlite3.Connection | None:
+        """Opens the on-disk cache on first use. Must be called with _lock held."""
+        if self._db is None and self._cache_path:
+            self._db = sqlite3.connect(self._cache_path, timeout=30, check_same_thread=False)
+            self._db.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, embedding BLOB NOT NULL)")
+            self._db.commit()
+        return self._db
+
+    @staticmethod
+    def _disk_key(text: str) -> str:
+        """Keys on-disk entries by model as well, so switching models never returns stale vectors."""
+        return hashlib.sha256(f"{EMBEDDING_BACKEND}|{EMBEDDING_MODEL_NAME}|{text}".encode("utf-8")).hexdigest()
+
+    def _remember(self, text: str, embedding):
+        """Stores an embedding, evicting the least recently used entry when full. Must be called with _lock held."""
+        self._cache[text] = embedding
+        self._cache.move_to_end(text)
+        if len(self._cache) > self._max_size:
+            self._cache.popitem(last=False)
+
+    def __call__(self, input: Documents) -> Embeddings:
+        with self._lock:
+            found = {text: self._cache[text] for text in input if text in self._cache}
+            for text in found:
+                self._cache.move_to_end(text)
+
+            db = self._get_db()
+            if db is not None:
+                keys = {self._disk_key(text): text for text in dict.fromkeys(input) if text not in found}
+                if keys:
+                    placeholders = ",".join("?" * len(keys))
+                    rows = db.execute(f"SELECT key, embedding FROM embeddings WHERE key IN ({placeholders})", list(keys))
+                    for key, blob in rows:
+                        found[keys[key]] = np.frombuffer(blob, dtype=np.float32)
+                        self._remember(keys[key], found[keys[key]])
+
+        misses = [text for text in dict.fromkeys(input) if text not in found]
+        if misses:
+            # Embed all uncached texts in one model batch
+            found.update(zip(misses, self._embedding_function(misses)))
+            with self._lock:
+                for text in misses:
+                    self._remember(text, found[text])
+
+                db = self._get_db()
+                if db is not None:
+                    db.executemany(
+                        "INSERT OR REPLACE INTO embeddings (key, embedding) VALUES (?, ?)",
+                        [(self._disk_key(text), np.asarray(found[text], dtype=np.float32).tobytes()) for text in misses]
+                    )
+                    db.commit()
+
+        return [found[text] for text in input]
+
+
+@functools.lru_cache(maxsize=1)
+def get_query_embedding_function():
+    """
+    Returns the process-wide embedding function for query texts: the shared model
+    behind an LRU cache persisted to QUERY_EMBEDDING_CACHE_PATH, so repeated keywords
+    skip the forward pass, also after a restart.
+    """
+    return CachedEmbeddingFunction(get_embedding_function(), cache_path=QUERY_EMBEDDING_CACHE_PATH)
+
+
+@functools.lru_cache(maxsize=1)
+def get_chroma_client():
+    """Returns the process-wide ChromaDB client for CHROMA_PERSIST_DIR, opening it on first use."""
+    return chromadb.PersistentClient(path=CHROMA_PERSIST_DIR)
+
+
+@functools.lru_cache(maxsize=None)
+def get_collection(name: str):
+    """
+    Returns the process-wide handle to an existing collection, queried through the cached embedding function.
+
+    The cached function reports the shared model's name and config, which is what
+    build_graphrag.py persisted with the collection, so Chroma accepts it on open.
+    """
+    return get_chroma_client().get_collection(
+        name=name,
+        embedding_function=get_query_embedding_function()
+    )
@@ -1,18 +1,23 @@
 import os
 import json
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 from openai import OpenAI
-from neo4j import GraphDatabase
-import chromadb
-from chromadb.utils import embedding_functions
 
-# Configuration - Load from environment variables
-NEO4J_URI = os.getenv("NEO4J_URI", "bolt://localhost:7687")
-NEO4J_USER = os.getenv("NEO4J_USER", "neo4j")
-NEO4J_PASSWORD = os.getenv("NEO4J_PASSWORD", "12345678")
-CHROMA_PERSIST_DIR = os.getenv("CHROMA_PERSIST_DIR", "/home/xli/NAS/home/bin/yoga-info-processing/chroma_db")
-PROMPT_FILE_PATH = "/home/xli/NAS/home/bin/yoga-info-processing/get_user_query_key_info.prompt"
+import llm_cache
+from query_prompt import get_query_prompt_template
+from neo4j_client import get_driver, close_driver
+from chroma_client import get_collection
 
+# Courses per batched verification request, to keep long descriptions well inside the context window
+COURSE_VERIFY_BATCH_SIZE = 20
+
+# Kept as a constant so every call sends the same query text and hits Neo4j's plan cache.
+GET_COURSE_DESCRIPTIONS_CYPHER = (
+    "UNWIND $course_names AS name "
+    "MATCH (c:Course {id: name}) "
+    "RETURN c.id AS name, c.description AS description"
+)
 
 class CourseFinder:
     """
@@ -30,17 +35,11 @@ class CourseFinder:
         self.api_client = None
         self.api_model = ""
         self._init_api_client(api_type)
+        self._prompt_template = get_query_prompt_template()
 
-        self.neo4j_driver = GraphDatabase.driver(NEO4J_URI, auth=(NEO4J_USER, NEO4J_PASSWORD))
+        self.neo4j_driver = get_driver()
 
-        chroma_client = chromadb.PersistentClient(path=CHROMA_PERSIST_DIR)
-        emb_func = embedding_functions.SentenceTransformerEmbeddingFunction(
-            model_name="all-MiniLM-L6-v2"
-        )
-        self.course_collection = chroma_client.get_collection(
-            name="yoga_course",
-            embedding_function=emb_func
-        )
+        self.course_collection = get_collection("yoga_course")
 
     def _init_api_client(self, api_type: str):
         """Initializes the LLM API client."""
@@ -50,78 +49,152 @@ class CourseFinder:
                 raise RuntimeError("Missing DEEPSEEK_API_KEY")
             self.api_client = OpenAI(
                 api_key=api_key,
-                base_url="https://api.deepseek.com/v1"
+                base_url="https://api.deepseek.com/v1",
+                max_retries=llm_cache.LLM_MAX_RETRIES
             )
             self.api_model = "deepseek-chat"
         elif api_type == 'openai':
             api_key = os.getenv('OPENAI_API_KEY')
             if not api_key:
                 raise RuntimeError("Missing OPENAI_API_KEY")
-            self.api_client = OpenAI(api_key=api_key)
+            self.api_client = OpenAI(api_key=api_key, max_retries=llm_cache.LLM_MAX_RETRIES)
             self.api_model = "gpt-3.5-turbo"
         else:
             raise ValueError("Unsupported API type")
 
     def _extract_query_info(self, user_query: str) -> dict:
         """Extracts structured info from user query using the LLM."""
-        with open(PROMPT_FILE_PATH, 'r') as f:
-            prompt_template = f.read().format(query=user_query)
+        prompt_template = self._prompt_template.format(query=user_query)
 
-        response = self.api_client.chat.completions.create(
-            model=self.api_model,
-            messages=[{"role": "user", "content": prompt_template}],
+        return llm_cache.complete(
+            self.api_client,
+            self.api_model,
+            prompt_template,
+            parse=json.loads,
             temperature=0.0,
             response_format={"type": "json_object"}
         )
-        return json.loads(response.choices[0].message.content)
 
     def _search_courses_by_keywords(self, keywords: list, k: int = 5) -> list:
         """Searches ChromaDB for courses matching keywords."""
-        course_names = set()
-        for keyword in keywords:
-            results = self.course_collection.query(
-                query_texts=[keyword],
-                n_results=k
-            )
-            course_names.update(results['ids'][0])
-        return list(course_names)
+        if not keywords:
+            return []
 
-    def _get_course_descriptions(self, course_names: list) -> dict:
-        """Retrieves course descriptions from Neo4j."""
+        # One batched query embeds and searches all keywords together; only the ids are needed.
+        results = self.course_collection.query(
+            query_texts=keywords,
+            n_results=k,
+            include=[]
+        )
+        return list(set().union(*results['ids']))
+
+    def _iter_course_descriptions(self, course_names: list):
+        """
+        Yields (name, description) pairs from Neo4j as the records arrive.
+        The session stays open until the pairs are consumed; the pooled driver makes opening one cheap.
+        """
         with self.neo4j_driver.session() as session:
-            result = session.run(
-                "UNWIND $course_names AS name "
-                "MATCH (c:Course {id: name}) "
-                "RETURN c.id AS name, c.description AS description",
-                course_names=course_names
-            )
-            return {record["name"]: record["description"] for record in result}
-
-    def _filter_courses_by_llm(self, course_descriptions: dict, user_query: str) -> list:
-        """Filters courses using LLM verification."""
-        yes_courses = []
-        na_courses = []
-
-        for name, description in course_descriptions.items():
-            prompt = (
-                f"Please answer if the Yoga course matches the user's query for a training. "
-                f"Course description: {description}\n"
-                f"User query: {user_query}\n\n"
-                "Answer only one of the three words: yes, no, or n/a"
-            )
+            result = session.run(GET_COURSE_DESCRIPTIONS_CYPHER, course_names=course_names)
+            for record in result:
+                yield record["name"], record["description"]
+
+    def _verify_course_by_llm(self, description: str, user_query: str) -> str:
+        """Asks the LLM whether a single course matches the query. Returns 'yes', 'no' or 'n/a'."""
+        prompt = (
+            f"Please answer if the Yoga course matches the user's query for a training. "
+            f"Course description: {description}\n"
+            f"User query: {user_query}\n\n"
+            "Answer only one of the three words: yes, no, or n/a"
+        )
+
+        completion = llm_cache.complete(
+            self.api_client,
+            self.api_model,
+            prompt,
+            temperature=0.3,
+            max_tokens=5
+        )
+        return completion.strip().lower()
+
+    def _verify_courses_in_batch(self, course_descriptions: dict, user_query: str) -> dict:
+        """
+        Asks the LLM to verify all courses in a single request.
+
+        Returns:
+            dict: A map of course name to 'yes', 'no' or 'n/a'.
 
-            response = self.api_client.chat.completions.create(
-                model=self.api_model,
-                messages=[{"role": "user", "content": prompt}],
-                temperature=0.3,
-                max_tokens=5
+        Raises:
+            ValueError: If the response is not the expected JSON shape.
+        """
+        course_list = "\n".join(
+            f"{i}. Course name: {name}\n   Course description: {description}"
+            for i, (name, description) in enumerate(course_descriptions.items(), 1)
+        )
+        prompt = (
+            f"Please answer if each Yoga course below matches the user's query for a training.\n"
+            f"User query: {user_query}\n\n"
+            f"Courses:\n{course_list}\n\n"
+            "Use the following json format to response, nothing else:\n"
+            '{"results": [{"name": "<course name>", "verdict": "yes" | "no" | "n/a"}]}'
+        )
+
+        def parse_verdicts(completion: str) -> dict:
+            results = json.loads(completion)["results"]
+            verdicts = {item["name"]: str(item["verdict"]).strip().lower() for item in results}
+            if set(verdicts) != set(course_descriptions):
+                raise ValueError(f"Batched verification returned unexpected courses: {list(verdicts)}")
+            return verdicts
+
+        return llm_cache.complete(
+            self.api_client,
+            self.api_model,
+            prompt,
+            parse=parse_verdicts,
+            temperature=0.3,
+            response_format={"type": "json_object"}
+        )
+
+    def _filter_courses_by_llm(self, course_descriptions, user_query: str) -> list:
+        """
+        Filters courses using LLM verification.
+
+        Args:
+            course_descriptions: An iterable of (name, description) pairs. Each full chunk is sent
+                to the LLM while the remaining pairs are still being read.
+            user_query (str): The user's natural language query.
+        """
+        descriptions = {}
+        verdicts = {}
+        unverified = {}
+        with ThreadPoolExecutor(max_workers=llm_cache.LLM_MAX_ASYNC) as executor:
+            futures = []
+            chunk = {}
+            for name, description in course_descriptions:
+                descriptions[name] = description
+                chunk[name] = description
+                if len(chunk) == COURSE_VERIFY_BATCH_SIZE:
+                    futures.append((chunk, executor.submit(self._verify_courses_in_batch, chunk, user_query)))
+                    chunk = {}
+            if chunk:
+                futures.append((chunk, executor.submit(self._verify_courses_in_batch, chunk, user_query)))
+
+            for chunk, future in futures:
+                try:
+                    verdicts.update(future.result())
+                except (KeyError, TypeError, ValueError) as e:
+                    # json.JSONDecodeError is a ValueError; these courses fall back to one request each.
+                    print(f"Batched course verification failed ({e}), verifying {len(chunk)} courses one by one.")
+                    unverified.update(chunk)
+
+            # The fallback requests are sent concurrently as well
+            answers = executor.map(
+                lambda description: self._verify_course_by_llm(description, user_query),
+                unverified.values()
             )
+            verdicts.update(zip(unverified, answers))
 
-            answer = response.choices[0].message.content.strip().lower()
-            if answer == "yes":
-                yes_courses.append(name)
-            elif answer == "n/a":
-                na_courses.append(name)
+        yes_courses = [name for name in descriptions if verdicts.get(name) == "yes"]
+        na_courses = [name for name in descriptions if verdicts.get(name) == "n/a"]
 
         return yes_courses if yes_courses else na_courses
 
@@ -139,38 +212,21 @@ class CourseFinder:
         query_info = self._extract_query_info(user_query)
         print(f"User's query info: {query_info}")
 
-        # Step 2: Semantic search for candidates
-        candidate_courses = set()
-
-        # Search by objectives
-        if query_info.get("objective"):
-            candidate_courses.update(
-                self._search_courses_by_keywords(
-                    query_info["objective"],
-                    k=3
-                )
-            )
-
-        # Search by body parts
-        if query_info.get("physical body parts to train"):
-            candidate_courses.update(
-                self._search_courses_by_keywords(
-                    query_info["physical body parts to train"],
-                    k=3
-                )
-            )
+        # Step 2: Semantic search for candidates, by objectives and by body parts.
+        # The results are unioned anyway, so both keyword lists go into one batched query.
+        keywords = (query_info.get("objective") or []) + (query_info.get("physical body parts to train") or [])
+        candidate_courses = self._search_courses_by_keywords(keywords, k=3)
 
         if not candidate_courses:
             return []
 
         # Step 3: Filter courses using LLM verification
-        course_descriptions = self._get_course_descriptions(list(candidate_courses))
+        course_descriptions = self._iter_course_descriptions(list(candidate_courses))
         return self._filter_courses_by_llm(course_descriptions, user_query)
 
     def close(self):
-        """Closes the Neo4j driver connection."""
-        if self.neo4j_driver:
-            self.neo4j_driver.close()
+        """Releases the finder's resources. The shared Neo4j driver is closed by the process owner."""
+        self.neo4j_driver = None
 
 
 # Example usage
@@ -204,3 +260,4 @@ if __name__ == "__main__":
     finally:
         if finder:
             finder.close()
+        close_driver()
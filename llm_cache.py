@@ -0,0 +1,160 @@
+import os
+import json
+import asyncio
+import contextlib
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict
+
+# Configuration - Load from environment variables
+# Upper bound on concurrent LLM requests, to stay under the provider's rate limits
+LLM_MAX_ASYNC = int(os.getenv("LLM_MAX_ASYNC", "8"))
+# The OpenAI SDK retries 429 and 5xx responses itself, honoring the retry-after header
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "5"))
+LLM_CACHE_SIZE = 4096
+# SQLite file backing the cache across runs and processes; set to an empty string to keep it in memory only
+LLM_CACHE_PATH = os.getenv(
+    "LLM_CACHE_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "llm_cache.sqlite3")
+)
+
+# Completion texts keyed by a hash of the request, shared by every LLM client in the process.
+_cache = OrderedDict()
+_lock = threading.Lock()
+_db = None
+
+
+def _get_db() -> sqlite3.Connection | None:
+    """Opens the on-disk cache on first use. Must be called with _lock held."""
+    global _db
+    if _db is None and LLM_CACHE_PATH:
+        _db = sqlite3.connect(LLM_CACHE_PATH, timeout=30, check_same_thread=False)
+        # The runner and the pose checker server share the file; WAL lets readers proceed during a write
+        _db.execute("PRAGMA journal_mode=WAL")
+        _db.execute("CREATE TABLE IF NOT EXISTS completions (key TEXT PRIMARY KEY, completion TEXT NOT NULL)")
+        _db.commit()
+    return _db
+
+
+def _remember(key: str, completion: str):
+    """Stores a completion in memory, evicting the least recently used entry when full."""
+    _cache[key] = completion
+    _cache.move_to_end(key)
+    if len(_cache) > LLM_CACHE_SIZE:
+        _cache.popitem(last=False)
+
+
+def make_key(model: str, prompt: str, **params) -> str:
+    """
+    Builds a content-addressed key for a completion request.
+
+    Args:
+        model (str): The model name.
+        prompt (str): The user prompt.
+        **params: Any other request parameters that change the answer (temperature, max_tokens, ...).
+    """
+    request = json.dumps({"model": model, "prompt": prompt, **params}, sort_keys=True)
+    return hashlib.sha256(request.encode("utf-8")).hexdigest()
+
+
+def get(key: str) -> str | None:
+    """Returns the cached completion text for the key, or None on a miss."""
+    with _lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            return _cache[key]
+
+        db = _get_db()
+        if db is None:
+            return None
+        row = db.execute("SELECT completion FROM completions WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        _remember(key, row[0])
+        return row[0]
+
+
+def put(key: str, completion: str):
+    """Stores a completion text in memory and, when enabled, on disk."""
+    with _lock:
+        _remember(key, completion)
+
+        db = _get_db()
+        if db is not None:
+            db.execute("INSERT OR REPLACE INTO completions (key, completion) VALUES (?, ?)", (key, completion))
+            db.commit()
+
+
+def _completion_text(response) -> str:
+    """
+    Returns the text of a chat completion response.
+
+    Raises:
+        ValueError: If the response has no text, e.g. it was filtered or was a refusal.
+    """
+    completion = response.choices[0].message.content
+    if completion is None:
+        raise ValueError("The LLM returned no content")
+    return completion
+
+
+def complete(client, model: str, prompt: str, parse=None, **params):
+    """
+    Sends a single-message chat completion and returns its text, or its parsed value when parse is given.
+    Identical requests are answered from the cache.
+
+    A completion is cached only after parse accepted it, so a malformed reply is asked
+    for again next time instead of failing every later run from the cache.
+
+    Args:
+        client: An OpenAI-compatible client.
+        model (str): The model name.
+        prompt (str): The user prompt.
+        parse: Optional callable that converts and validates the completion text, raising on a bad reply.
+        **params: Other request parameters, passed on to the API and part of the cache key.
+    """
+    parse = parse or (lambda completion: completion)
+    key = make_key(model, prompt, **params)
+    completion = get(key)
+    if completion is not None:
+        return parse(completion)
+
+    response = client.chat.completions.create(
+        model=model,
+        messages=[{"role": "user", "content": prompt}],
+        **params
+    )
+    completion = _completion_text(response)
+    result = parse(completion)
+    put(key, completion)
+    return result
+
+
+async def acomplete(client, model: str, prompt: str, parse=None, semaphore: asyncio.Semaphore | None = None, **params):
+    """
+    Async variant of complete() for an AsyncOpenAI-compatible client.
+
+    The cache is read and written in a worker thread, since SQLite may wait on the
+    file lock held by another process and must not stall the event loop.
+
+    Args:
+        semaphore (asyncio.Semaphore | None): Optional limit on concurrent API requests.
+            Cache hits do not take it.
+    """
+    parse = parse or (lambda completion: completion)
+    key = make_key(model, prompt, **params)
+    completion = await asyncio.to_thread(get, key)
+    if completion is not None:
+        return parse(completion)
+
+    async with semaphore or contextlib.nullcontext():
+        response = await client.chat.completions.create(
+            model=model,
+            messages=[{"role": "user", "content": prompt}],
+            **params
+        )
+    completion = _completion_text(response)
+    result = parse(completion)
+    await asyncio.to_thread(put, key, completion)
+    return result
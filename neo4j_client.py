@@ -0,0 +1,61 @@
+import os
+import logging
+import functools
+from neo4j import GraphDatabase
+from neo4j.exceptions import DriverError, Neo4jError
+
+# Configuration - Load from environment variables
+NEO4J_URI = os.getenv("NEO4J_URI", "bolt://localhost:7687")
+NEO4J_USER = os.getenv("NEO4J_USER", "neo4j")
+NEO4J_PASSWORD = os.getenv("NEO4J_PASSWORD", "12345678")
+# Upper bound on open Bolt connections of the shared driver
+NEO4J_POOL = int(os.getenv("NEO4J_POOL", "50"))
+# Labels whose nodes are looked up by id
+ID_LABELS = ["Attribute", "Category", "Challenge", "Pose", "Course"]
+
+
+def ensure_constraints(driver):
+    """
+    Creates uniqueness constraints on node ids so MERGE and MATCH on id use index seeks
+    instead of label scans. Idempotent; existing constraints are left untouched.
+
+    Best effort: a user without schema rights, a read replica, a conflicting index or an
+    unreachable server only logs a warning, so read-only clients still start and the
+    caller's own connection check can report the problem.
+    """
+    try:
+        with driver.session() as session:
+            for label in ID_LABELS:
+                session.run(
+                    f"CREATE CONSTRAINT {label.lower()}_id IF NOT EXISTS "
+                    f"FOR (n:{label}) REQUIRE n.id IS UNIQUE"
+                ).consume()
+    except (Neo4jError, DriverError) as e:
+        logging.warning(f"Could not ensure the Neo4j id constraints: {e}")
+
+
+@functools.lru_cache(maxsize=1)
+def get_driver():
+    """
+    Returns the process-wide Neo4j driver, connecting on first use.
+
+    The driver keeps a pool of Bolt connections, so the checker, the finders and the
+    agents share warm connections instead of each doing its own TCP and auth handshake.
+    Sessions are cheap and should still be opened per unit of work.
+    """
+    driver = GraphDatabase.driver(
+        NEO4J_URI,
+        auth=(NEO4J_USER, NEO4J_PASSWORD),
+        max_connection_pool_size=NEO4J_POOL,
+        connection_acquisition_timeout=30
+    )
+    # Also covers graphs built before the constraints were introduced
+    ensure_constraints(driver)
+    return driver
+
+
+def close_driver():
+    """Closes the shared driver if it was created. Call once when the process shuts down."""
+    if get_driver.cache_info().currsize:
+        get_driver().close()
+        get_driver.cache_clear()
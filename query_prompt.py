@@ -0,0 +1,21 @@
+import os
+import functools
+
+# Configuration - Load from environment variables
+PROMPT_FILE_PATH = os.getenv("PROMPT_FILE_PATH", "/home/xli/NAS/home/bin/yoga-info-processing/get_user_query_key_info.prompt")
+
+
+@functools.lru_cache(maxsize=1)
+def get_query_prompt_template() -> str:
+    """
+    Returns the query extraction prompt template, reading the file once per process.
+    Clients call it in their constructors, so a missing file fails at construction, not on the first query.
+
+    Raises:
+        RuntimeError: If the prompt file does not exist.
+    """
+    try:
+        with open(PROMPT_FILE_PATH, 'r') as f:
+            return f.read()
+    except FileNotFoundError:
+        raise RuntimeError(f"Prompt file not found at {PROMPT_FILE_PATH}")
@@ -1,44 +1,35 @@
 import os
 import json
+import random
 import argparse
 from openai import OpenAI
-from neo4j import GraphDatabase
-import chromadb
-from chromadb.utils import embedding_functions
 
-# Configuration - Load from environment variables
-NEO4J_URI = os.getenv("NEO4J_URI", "bolt://localhost:7687")
-NEO4J_USER = os.getenv("NEO4J_USER", "neo4j")
-NEO4J_PASSWORD = os.getenv("NEO4J_PASSWORD", "12345678")
-CHROMA_PERSIST_DIR = os.getenv("CHROMA_PERSIST_DIR", "/home/xli/NAS/home/bin/yoga-info-processing/chroma_db")
-PROMPT_FILE_PATH = "/home/xli/NAS/home/bin/yoga-info-processing/get_user_query_key_info.prompt"
+import llm_cache
+from query_prompt import get_query_prompt_template
+from chroma_client import get_collection
+from neo4j_client import get_driver, close_driver
 
 class CategoryCourseRecommender:
     """
     Recommends a yoga course by finding poses from relevant categories based on user objectives.
     """
 
-    def __init__(self, api_type: str):
+    def __init__(self, api_type: str, neo4j_driver=None, category_collection=None):
         """
         Initializes the recommender with API, Neo4j, and ChromaDB clients.
 
         Args:
             api_type (str): The model API to use ('openai' or 'deepseek').
+            neo4j_driver: Optional Neo4j driver; defaults to the shared process-wide driver.
+            category_collection: Optional ChromaDB category collection; defaults to the shared handle.
         """
         self.api_client = None
         self.api_model = ""
         self._init_api_client(api_type)
+        self._prompt_template = get_query_prompt_template()
 
-        self.neo4j_driver = GraphDatabase.driver(NEO4J_URI, auth=(NEO4J_USER, NEO4J_PASSWORD))
-
-        chroma_client = chromadb.PersistentClient(path=CHROMA_PERSIST_DIR)
-        emb_func = embedding_functions.SentenceTransformerEmbeddingFunction(
-            model_name="all-MiniLM-L6-v2"
-        )
-        self.category_collection = chroma_client.get_collection(
-            name="yoga_category",
-            embedding_function=emb_func
-        )
+        self.neo4j_driver = neo4j_driver if neo4j_driver is not None else get_driver()
+        self.category_collection = category_collection if category_collection is not None else get_collection("yoga_category")
 
     def _init_api_client(self, api_type: str):
         """Initializes the LLM API client."""
@@ -48,84 +39,80 @@ class CategoryCourseRecommender:
                 raise RuntimeError("Missing DEEPSEEK_API_KEY")
             self.api_client = OpenAI(
                 api_key=api_key,
-                base_url="https://api.deepseek.com/v1"
+                base_url="https://api.deepseek.com/v1",
+                max_retries=llm_cache.LLM_MAX_RETRIES
             )
             self.api_model = "deepseek-chat"
         elif api_type == 'openai':
             api_key = os.getenv('OPENAI_API_KEY')
             if not api_key:
                 raise RuntimeError("Missing OPENAI_API_KEY")
-            self.api_client = OpenAI(api_key=api_key)
+            self.api_client = OpenAI(api_key=api_key, max_retries=llm_cache.LLM_MAX_RETRIES)
             self.api_model = "gpt-3.5-turbo"
         else:
             raise ValueError("Unsupported API type")
 
     def _extract_query_info(self, user_query: str) -> dict:
         """Extracts structured info from user query using the LLM."""
-        try:
-            with open(PROMPT_FILE_PATH, 'r') as f:
-                prompt_template = f.read().format(query=user_query)
-        except FileNotFoundError:
-            raise RuntimeError(f"Prompt file not found at {PROMPT_FILE_PATH}")
-
-        response = self.api_client.chat.completions.create(
-            model=self.api_model,
-            messages=[{"role": "user", "content": prompt_template}],
+        prompt_template = self._prompt_template.format(query=user_query)
+
+        return llm_cache.complete(
+            self.api_client,
+            self.api_model,
+            prompt_template,
+            parse=json.loads,
             temperature=0.0,
             response_format={"type": "json_object"}
         )
-        return json.loads(response.choices[0].message.content)
 
     def _find_similar_categories(self, objectives: list, k: int = 2) -> list:
         """Finds similar yoga categories from ChromaDB based on objectives."""
         if not objectives:
             return []
         
+        # Already one batched query for all objectives; only the ids are needed.
         results = self.category_collection.query(
             query_texts=objectives,
-            n_results=k
+            n_results=k,
+            include=[]
         )
         # Flatten the list of lists and remove duplicates
         category_names = list(set([item for sublist in results['ids'] for item in sublist]))
         return category_names
 
-    def _get_random_pose_for_category(self, tx, category_name: str) -> str | None:
-        """Gets a random pose name for a given category from Neo4j."""
-        result = tx.run(
-            """
-            MATCH (c:Category {id: $category_name})<-[:IN_CATEGORY]-(p:Pose)
-            RETURN p.id AS pose_name
-            ORDER BY rand()
-            LIMIT 1
-            """,
-            category_name=category_name
-        )
-        record = result.single()
-        return record["pose_name"] if record else None
-
-    def _find_related_poses(self, tx, pose_name: str) -> dict:
-        """Finds preceding and succeeding poses for a given pose."""
-        preceding_query = """
-        MATCH (preceding:Pose)<-[:BUILD_UP]-(current:Pose {id: $pose_name})
-        RETURN preceding.id AS pose_name
-        LIMIT 1
+    def _get_poses_for_categories(self, tx, category_names: list) -> dict:
         """
-        succeeding_query = """
-        MATCH (current:Pose {id: $pose_name})-[:BALANCE_OUT|UNWIND]->(succeeding:Pose)
-        RETURN succeeding.id AS pose_name
-        ORDER BY rand()
-        LIMIT 1
+        Picks a random pose for each category, with its preceding and succeeding poses, in a single query.
+
+        Returns:
+            dict: A map of category name to {"current", "preceding", "succeeding"} pose names.
+            Categories without poses are left out.
         """
-        
-        preceding_result = tx.run(preceding_query, pose_name=pose_name).single()
-        succeeding_result = tx.run(succeeding_query, pose_name=pose_name).single()
-        result = {
-            "preceding": preceding_result["pose_name"] if preceding_result else None,
-            "succeeding": succeeding_result["pose_name"] if succeeding_result else None,
+        query = """
+        UNWIND $category_names AS category_name
+        CALL {
+            WITH category_name
+            MATCH (:Category {id: category_name})<-[:IN_CATEGORY]-(p:Pose)
+            RETURN p AS current
+            ORDER BY rand()
+            LIMIT 1
         }
+        RETURN category_name,
+               current.id AS current,
+               head([(current)-[:BUILD_UP]->(preceding:Pose) | preceding.id]) AS preceding,
+               [(current)-[:BALANCE_OUT|UNWIND]->(succeeding:Pose) | succeeding.id] AS succeeding
+        """
 
-        return result
-
+        poses = {}
+        for record in tx.run(query, category_names=category_names):
+            # Pick the succeeding pose here rather than with ORDER BY rand() in Cypher
+            succeeding = record["succeeding"]
+            poses[record["category_name"]] = {
+                "current": record["current"],
+                "preceding": record["preceding"],
+                "succeeding": random.choice(succeeding) if succeeding else None,
+            }
+        return poses
 
     def recommend_course(self, user_query: str) -> list:
         """
@@ -153,36 +140,34 @@ class CategoryCourseRecommender:
         print(f"Found similar categories: {similar_categories}")
 
         # Step 3: Build sequence for each category
-        final_sequence = []
         with self.neo4j_driver.session() as session:
-            for category in similar_categories:
-                current_pose = session.execute_read(self._get_random_pose_for_category, category)
-                if not current_pose:
-                    print(f"No pose found for category: {category}")
-                    continue
-                
-                related_poses = session.execute_read(self._find_related_poses, current_pose)
-                
-                mini_sequence = []
-                if related_poses.get("preceding"):
-                    mini_sequence.append(related_poses["preceding"])
-                
-                mini_sequence.append(current_pose)
-                
-                if related_poses.get("succeeding"):
-                    mini_sequence.append(related_poses["succeeding"])
-                
-                print(f"Generated sequence for category '{category}': {mini_sequence}")
-                final_sequence.extend(mini_sequence)
+            category_poses = session.execute_read(self._get_poses_for_categories, similar_categories)
+
+        final_sequence = []
+        for category in similar_categories:
+            related_poses = category_poses.get(category)
+            if not related_poses:
+                print(f"No pose found for category: {category}")
+                continue
+            
+            mini_sequence = []
+            if related_poses["preceding"]:
+                mini_sequence.append(related_poses["preceding"])
+            
+            mini_sequence.append(related_poses["current"])
+            
+            if related_poses["succeeding"]:
+                mini_sequence.append(related_poses["succeeding"])
+            
+            print(f"Generated sequence for category '{category}': {mini_sequence}")
+            final_sequence.extend(mini_sequence)
         
         # Remove duplicates while preserving order
-        seen = set()
-        return [x for x in final_sequence if not (x in seen or seen.add(x))]
+        return list(dict.fromkeys(final_sequence))
 
     def close(self):
-        """Closes the Neo4j driver connection."""
-        if self.neo4j_driver:
-            self.neo4j_driver.close()
+        """Releases the recommender's resources. The shared Neo4j driver is closed by the process owner."""
+        self.neo4j_driver = None
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
@@ -218,3 +203,4 @@ if __name__ == "__main__":
     finally:
         if recommender:
             recommender.close()
+        close_driver()
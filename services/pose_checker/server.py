@@ -7,6 +7,7 @@ from fastapi import FastAPI, HTTPException
 import uvicorn
 
 from check_yoga_pose import YogaPoseChecker
+from neo4j_client import close_driver
 
 # --- Data Structures ---
 # These define the API contract for our service.
@@ -40,6 +41,7 @@ async def lifespan(app: FastAPI):
     # Clean up resources on shutdown
     if yoga_pose_checker_instance:
         yoga_pose_checker_instance.close()
+    close_driver()
     logging.info("YogaPoseChecker resources have been shut down.")
 
 # --- FastAPI Application ---
@@ -62,7 +64,7 @@ async def check_pose_endpoint(request: CheckPoseRequest) -> CheckPoseResponse:
     logging.info(f"Received request to check pose: {request.pose_name}")
     
     original_pose = request.pose_name
-    final_pose = yoga_pose_checker_instance.check_and_replace_pose(
+    final_pose = await yoga_pose_checker_instance.check_and_replace_pose(
         pose_name=original_pose,
         user_query=request.user_query
     )
@@ -0,0 +1,94 @@
+import os
+import shutil
+
+import pytest
+
+pytest.importorskip("chromadb")
+
+import numpy as np
+from chromadb.api.types import Documents, EmbeddingFunction
+
+import chroma_client
+
+REPO_CHROMA_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "chroma_db")
+
+
+class CountingEmbeddingFunction(EmbeddingFunction[Documents]):
+    """Embeds each text as its length and records which texts reached the model."""
+
+    def __init__(self):
+        self.embedded = []
+
+    def __call__(self, input: Documents):
+        self.embedded.extend(input)
+        return [np.array([len(text), 1.0], dtype=np.float32) for text in input]
+
+
+def clear_shared_handles():
+    chroma_client.get_collection.cache_clear()
+    chroma_client.get_chroma_client.cache_clear()
+    chroma_client.get_query_embedding_function.cache_clear()
+
+
+@pytest.fixture(scope="module")
+def shipped_chroma_dir(tmp_path_factory):
+    """A copy of the shipped ChromaDB, so opening it never touches the checked-in files."""
+    pytest.importorskip("sentence_transformers")
+    if not os.path.exists(os.path.join(REPO_CHROMA_DIR, "chroma.sqlite3")):
+        pytest.skip("chroma_db is not available")
+    path = tmp_path_factory.mktemp("chroma") / "chroma_db"
+    shutil.copytree(REPO_CHROMA_DIR, path)
+    return str(path)
+
+
+@pytest.fixture
+def shared_handles(shipped_chroma_dir, tmp_path, monkeypatch):
+    monkeypatch.setattr(chroma_client, "CHROMA_PERSIST_DIR", shipped_chroma_dir)
+    monkeypatch.setattr(chroma_client, "QUERY_EMBEDDING_CACHE_PATH", str(tmp_path / "query_embedding_cache.sqlite3"))
+    clear_shared_handles()
+    yield
+    clear_shared_handles()
+
+
+@pytest.mark.parametrize("name", ["yoga_pose", "yoga_course", "yoga_category"])
+def test_get_collection_opens_persisted_collection(shared_handles, name):
+    collection = chroma_client.get_collection(name)
+
+    assert collection.count() > 0
+    results = collection.query(query_texts=["lower back"], n_results=1, include=[])
+    assert len(results["ids"][0]) == 1
+
+
+def test_get_collection_shares_one_handle_with_the_cached_function(shared_handles):
+    collection = chroma_client.get_collection("yoga_course")
+
+    assert chroma_client.get_collection("yoga_course") is collection
+    embedding_function = chroma_client.get_query_embedding_function()
+    assert embedding_function.name() == chroma_client.get_embedding_function().name()
+    assert embedding_function.get_config() == chroma_client.get_embedding_function().get_config()
+
+def test_cached_embedding_function_embeds_only_misses(tmp_path):
+    cache_path = str(tmp_path / "query_embedding_cache.sqlite3")
+    model = CountingEmbeddingFunction()
+    cached = chroma_client.CachedEmbeddingFunction(model, cache_path=cache_path)
+
+    first = cached(["core", "lower back", "core"])
+    second = cached(["lower back", "stress"])
+
+    assert model.embedded == ["core", "lower back", "stress"]
+    np.testing.assert_array_equal(first[0], first[2])
+    np.testing.assert_array_equal(first[1], second[0])
+
+
+def test_cached_embedding_function_reads_disk_cache_after_restart(tmp_path):
+    cache_path = str(tmp_path / "query_embedding_cache.sqlite3")
+    expected = chroma_client.CachedEmbeddingFunction(CountingEmbeddingFunction(), cache_path=cache_path)(["core"])
+
+    # A new instance starts with an empty in-memory cache, like a new process
+    model = CountingEmbeddingFunction()
+    cached = chroma_client.CachedEmbeddingFunction(model, cache_path=cache_path)
+
+    np.testing.assert_array_equal(cached(["core"])[0], expected[0])
+    assert model.embedded == []
+    cached(["stress"])
+    assert model.embedded == ["stress"]
@@ -3,10 +3,21 @@ import logging
 import subprocess
 import time
 import requests
+from requests.adapters import HTTPAdapter
 import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 from agents.course_finder.agent import CourseFinderAgent, FindCoursesRequest
 from agents.category_recommender.agent import CategoryRecommenderAgent, ComposeCourseRequest
+from neo4j_client import close_driver
+
+# Matches the Uvicorn startup line, e.g. "Uvicorn running on http://127.0.0.1:54389"
+SERVER_ADDRESS_PATTERN = re.compile(r"Uvicorn running on (http://[0-9\.:]+)")
+# Seconds to wait for the API server to report its address
+SERVER_START_TIMEOUT = 60
+# Upper bound on concurrent /check-pose requests while validating a sequence
+POSE_CHECK_MAX_WORKERS = 16
 
 class YogaApplicationRunner:
     """
@@ -17,52 +28,67 @@ class YogaApplicationRunner:
         self.api_base_url = api_base_url
         self.course_finder_agent = CourseFinderAgent(api_type=self.api_type)
         self.category_recommender_agent = CategoryRecommenderAgent(api_type=self.api_type)
+        # Keep-alive connections to the pose checker, one per concurrent check
+        self._session = requests.Session()
+        self._session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=POSE_CHECK_MAX_WORKERS))
+
+    def _check_pose(self, pose_name: str, user_query: str) -> str | None:
+        """
+        Checks a single pose by calling the pose checker API.
+
+        Returns:
+            The validated or replacement pose name, or None if the pose has to be removed.
+        """
+        check_url = f"{self.api_base_url}/check-pose"
+        try:
+            payload = {"pose_name": pose_name, "user_query": user_query}
+            logging.info(f"Attempting to check pose '{pose_name}' via API: {check_url} with payload {payload}")
+            response = self._session.post(check_url, json=payload, timeout=45)
+            response.raise_for_status()  # Raise an exception for bad status codes (4xx or 5xx)
+
+            result = response.json()
+            final_pose_name = result.get("final_pose_name")
+
+            if final_pose_name:
+                if result.get("was_replaced"):
+                    logging.info(f"Pose '{pose_name}' was replaced with '{final_pose_name}'.")
+            else:
+                logging.warning(f"Pose '{pose_name}' was unsuitable and removed (no replacement found).")
+            return final_pose_name
+
+        except requests.exceptions.ConnectionError as e:
+            logging.error(f"Connection error checking pose '{pose_name}'. Is the server running at {check_url}? Error: {e}")
+        except requests.exceptions.Timeout as e:
+            logging.error(f"Timeout checking pose '{pose_name}'. Server took too long to respond. Error: {e}")
+        except requests.exceptions.HTTPError as e:
+            logging.error(f"HTTP error checking pose '{pose_name}': {e}. Response: {e.response.text}")
+        except requests.exceptions.RequestException as e:
+            logging.error(f"General request error checking pose '{pose_name}': {e}. It will be removed.")
+        except Exception as e:
+            logging.error(f"An unexpected error occurred while processing pose '{pose_name}': {e}. It will be removed.")
+        return None
 
     def _validate_sequence(self, sequence: list[str], user_query: str) -> list[str] | None:
         """
         Validates a sequence of poses by calling the pose checker API.
+        Each distinct pose is checked once, concurrently; the sequence order is preserved.
 
         Returns:
             A validated list of pose names, or None if the sequence is unacceptable.
         """
-        validated_sequence = []
-        removed_poses_count = 0
         max_removals_allowed = 2
-        check_url = f"{self.api_base_url}/check-pose"
 
-        for pose_name in sequence:
-            try:
-                payload = {"pose_name": pose_name, "user_query": user_query}
-                logging.info(f"Attempting to check pose '{pose_name}' via API: {check_url} with payload {payload}")
-                response = requests.post(check_url, json=payload, timeout=45)
-                response.raise_for_status()  # Raise an exception for bad status codes (4xx or 5xx)
-
-                result = response.json()
-                final_pose_name = result.get("final_pose_name")
-
-                if final_pose_name:
-                    validated_sequence.append(final_pose_name)
-                    if result.get("was_replaced"):
-                        logging.info(f"Pose '{pose_name}' was replaced with '{final_pose_name}'.")
-                else:
-                    removed_poses_count += 1
-                    logging.warning(f"Pose '{pose_name}' was unsuitable and removed (no replacement found).")
-
-            except requests.exceptions.ConnectionError as e:
-                logging.error(f"Connection error checking pose '{pose_name}'. Is the server running at {check_url}? Error: {e}")
-                removed_poses_count += 1
-            except requests.exceptions.Timeout as e:
-                logging.error(f"Timeout checking pose '{pose_name}'. Server took too long to respond. Error: {e}")
-                removed_poses_count += 1
-            except requests.exceptions.HTTPError as e:
-                logging.error(f"HTTP error checking pose '{pose_name}': {e}. Response: {e.response.text}")
-                removed_poses_count += 1
-            except requests.exceptions.RequestException as e:
-                logging.error(f"General request error checking pose '{pose_name}': {e}. It will be removed.")
-                removed_poses_count += 1
-            except Exception as e:
-                logging.error(f"An unexpected error occurred while processing pose '{pose_name}': {e}. It will be removed.")
-                removed_poses_count += 1
+        if not sequence:
+            return []
+
+        # Repeated poses would send identical LLM requests at the same moment, all missing the cache
+        unique_poses = list(dict.fromkeys(sequence))
+        with ThreadPoolExecutor(max_workers=min(len(unique_poses), POSE_CHECK_MAX_WORKERS)) as executor:
+            checked_poses = dict(zip(unique_poses, executor.map(lambda pose_name: self._check_pose(pose_name, user_query), unique_poses)))
+        final_pose_names = [checked_poses[pose_name] for pose_name in sequence]
+
+        validated_sequence = [name for name in final_pose_names if name]
+        removed_poses_count = len(sequence) - len(validated_sequence)
 
         if removed_poses_count > max_removals_allowed:
             logging.error(f"Course rejected: {removed_poses_count} poses were removed, which is more than the allowed {max_removals_allowed}.")
@@ -117,6 +143,7 @@ class YogaApplicationRunner:
         print("\n😞 Sorry, after multiple attempts, we could not create a suitable yoga course for your query.")
 
     def close(self):
+        self._session.close()
         self.course_finder_agent.close()
         self.category_recommender_agent.close()
 
@@ -146,19 +173,32 @@ def main():
         cmd = ["python", "-m", "services.pose_checker.server", "--api", args.api, "--port", "0", "--host", "127.0.0.1"]
         api_server_process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
         
-        # Wait for the server to start and extract its address
+        # Drain the server output in the background for the whole run; an undrained pipe
+        # fills up and blocks the server once it has logged enough.
         server_address = None
-        for line in iter(api_server_process.stdout.readline, ''):
-            logging.info(f"[API Server]: {line.strip()}")
-            # Look for the line like: "Uvicorn running on http://127.0.0.1:54389"
-            match = re.search(r"Uvicorn running on (http://[0-9\.:]+)", line)
-            if match:
-                server_address = match.group(1)
-                logging.info(f"Detected API server running at: {server_address}")
-                break
-            if api_server_process.poll() is not None:
-                logging.error("API server process terminated unexpectedly.")
-                break
+        address_event = threading.Event()
+
+        def drain_server_output():
+            nonlocal server_address
+            for line in iter(api_server_process.stdout.readline, ''):
+                logging.info(f"[API Server]: {line.strip()}")
+                if not address_event.is_set():
+                    match = SERVER_ADDRESS_PATTERN.search(line)
+                    if match:
+                        server_address = match.group(1)
+                        address_event.set()
+            # Output closed: the server has exited, so stop waiting for its address
+            address_event.set()
+
+        threading.Thread(target=drain_server_output, daemon=True).start()
+
+        # Wait for the server to start and report its address
+        if not address_event.wait(timeout=SERVER_START_TIMEOUT):
+            logging.error(f"API server did not report its address within {SERVER_START_TIMEOUT} seconds.")
+        elif server_address is None:
+            logging.error("API server process terminated unexpectedly.")
+        else:
+            logging.info(f"Detected API server running at: {server_address}")
         
         if server_address is None:
             raise RuntimeError("Could not determine API server address after waiting.")
@@ -172,6 +212,7 @@ def main():
     finally:
         if runner:
             runner.close()
+        close_driver()
         if api_server_process:
             api_server_process.terminate()
             api_server_process.wait()